@@ -1,10 +1,11 @@
 import configparser
 from datetime import datetime
 import os
-from pyspark.sql import SparkSession
-from pyspark.sql.types import StructType, StructField, StringType, DoubleType, LongType, TimestampType, IntegerType, FloatType
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, Window
+from pyspark.sql.types import StructType, StructField, StringType, DoubleType, LongType, TimestampType, IntegerType
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
-from pyspark.sql.functions import udf, col, to_timestamp, monotonically_increasing_id
+from pyspark.sql.functions import udf, col, xxhash64, broadcast, row_number, rand, explode, array, lit
 
 
 config = configparser.ConfigParser()
@@ -13,18 +14,87 @@ config.read_file(open('dl.cfg'))
 os.environ['AWS_ACCESS_KEY_ID']=config.get('AWS','AWS_ACCESS_KEY_ID')
 os.environ['AWS_SECRET_ACCESS_KEY']=config.get('AWS','AWS_SECRET_ACCESS_KEY')
 
+# salting is only worth it once the song catalog is too big to broadcast
+SALT_SONGPLAYS_JOIN = config.getboolean('ETL', 'SALT_SONGPLAYS_JOIN', fallback=False)
+SALT_BUCKETS = config.getint('ETL', 'SALT_BUCKETS', fallback=32)
 
-def create_spark_session():
+# schema for song files
+SONG_SCHEMA = StructType([
+    StructField('artist_id', StringType(), True),
+    StructField('artist_latitude', DoubleType(), True),
+    StructField('artist_longitude', DoubleType(), True),
+    StructField('artist_location', StringType(), True),
+    StructField('artist_name', StringType(), True),
+    StructField('song_id', StringType(), True),
+    StructField('title', StringType(), True),
+    StructField('duration', DoubleType(), True),
+    StructField('year', DoubleType(), True),
+])
+
+# schema for log files
+LOG_SCHEMA = StructType([
+    StructField('artist', StringType(), True),
+    StructField('auth', StringType(), True),
+    StructField('firstName', StringType(), True),
+    StructField('gender', StringType(), True),
+    StructField('itemInSession', LongType(), True),
+    StructField('lastName', StringType(), True),
+    StructField('length', DoubleType(), True),
+    StructField('level', StringType(), True),
+    StructField('location', StringType(), True),
+    StructField('method', StringType(), True),
+    StructField('page', StringType(), True),
+    StructField('registration', DoubleType(), True),
+    StructField('sessionId', IntegerType(), True),
+    StructField('song', StringType(), True),
+    StructField('status', IntegerType(), True),
+    StructField('ts', LongType(), True),
+    StructField('userAgent', StringType(), True),
+    StructField('userId', StringType(), True),
+])
+
+
+def create_spark_session(output_data):
     """
     Create and return SparkSession object
     
+    Args:
+        output_data (str): location to write parquet files, the S3A committer 
+            is only configured when this is an s3a:// location.
+    
     Returns:
         TYPE: Spark Session object
     """
-    spark = SparkSession \
+    builder = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+        .config("spark.hadoop.fs.s3a.connection.maximum", "200") \
+        .config("spark.sql.autoBroadcastJoinThreshold", 200 * 1024 * 1024) \
+        .config("spark.sql.parquet.compression.codec", "zstd") \
+        .config("spark.hadoop.parquet.compression.codec.zstd.level", "3") \
+        .config("spark.hadoop.parquet.enable.dictionary", "true") \
+        .config("spark.hadoop.parquet.page.size", "1048576") \
+        .config("spark.hadoop.parquet.block.size", "134217728") \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.sql.adaptive.skewJoin.skewedPartitionFactor", "5") \
+        .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "64m") \
+        .config("spark.sql.adaptive.localShuffleReader.enabled", "true") \
+        .config("spark.dynamicAllocation.enabled", "true") \
+        .config("spark.dynamicAllocation.shuffleTracking.enabled", "true")
+    
+    # the magic committer avoids copy-on-rename when writing to S3, it needs 
+    # hadoop-aws and spark-hadoop-cloud on the classpath (see README)
+    if output_data.startswith("s3a://"):
+        builder = builder \
+            .config("spark.hadoop.fs.s3a.committer.name", "magic") \
+            .config("spark.hadoop.fs.s3a.committer.magic.enabled", "true") \
+            .config("spark.sql.sources.commitProtocolClass", 
+                    "org.apache.spark.internal.io.cloud.PathOutputCommitProtocol") \
+            .config("spark.sql.parquet.output.committer.class", 
+                    "org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter")
+    
+    spark = builder.getOrCreate()
     return spark
 
 
@@ -36,6 +106,9 @@ def process_song_data(spark, input_data, output_data):
         spark (SparkSession): SparkSessionObject
         input_data (str): location of JSON files.
         output_data (str): location to write parquet files.
+    
+    Returns:
+        DataFrame: the cached song data, for reuse by process_log_data.
     """
     # get filepath to song data file
     
@@ -43,180 +116,173 @@ def process_song_data(spark, input_data, output_data):
     
     song_data = input_data + "song-data/*/*/*/*.json"
     
-    #Define a schema for the data
-    schema = StructType([
-        StructField('artist_id', StringType(), True),
-        StructField('artist_latitude', DoubleType(), True),
-        StructField('artist_longitude', DoubleType(), True),
-        StructField('artist_location', StringType(), True),
-        StructField('artist_name', StringType(), True),
-        StructField('song_id', StringType(), True),
-        StructField('title', StringType(), True),
-        StructField('duration', DoubleType(), True),
-        StructField('year', DoubleType(), True),
-    ])
-    
     print("Reading files... {}".format(song_data))
-    # read song data file
-    df = spark.read.json(song_data, schema=schema)
+    # read song data file, dropping malformed records rather than keeping a 
+    # corrupt record column, cached as it is also used for the songplays table
+    df = spark.read.schema(SONG_SCHEMA) \
+        .option('mode', 'DROPMALFORMED') \
+        .json(song_data) \
+        .persist(StorageLevel.DISK_ONLY)
 
     # extract columns to create songs table
     print("Selecting song table")
     songs_table = df.select('song_id', 'artist_id', 'year', 'duration')
     
     print("Writing songs table")
-    # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy('year', 'artist_id').parquet(output_data + "songs.parquet", 
-                                                               mode="overwrite")
+    spark.sparkContext.setJobGroup('songs', 'Write songs table')
+    # write songs table to parquet files partitioned by year, repartitioning 
+    # first so each directory gets a single file
+    songs_table.repartition('year') \
+               .write.partitionBy('year').parquet(output_data + "songs.parquet", 
+                                                  mode="overwrite")
     
     print("Selecting artist table")
     # extract columns to create artists table
-    artist_table = df.select('artist_id', 
-                             col('artist_name').alias('name'), 
-                             col('artist_location').alias('location'),
-                             col('artist_latitude').alias('latitude'), 
-                             col('artist_longitude').alias('longitude')).distinct()
+    artist_table = df.selectExpr('artist_id', 
+                                 'artist_name as name', 
+                                 'artist_location as location',
+                                 'artist_latitude as latitude', 
+                                 'artist_longitude as longitude').distinct()
     
     print("Writing artist table")
-    # write artists table to parquet files
-    artist_table.write.parquet(output_data + "artist.parquet", 
-                              mode="overwrite")
+    spark.sparkContext.setJobGroup('artists', 'Write artists table')
+    # write artists table to a single parquet file, sorted so dictionary and 
+    # run-length encoding compress the repeated values well
+    artist_table.repartition(1) \
+                .sortWithinPartitions('artist_id') \
+                .write.parquet(output_data + "artist.parquet", mode="overwrite")
+    spark.sparkContext.setJobGroup(None, None)
 
     print("Finished processing song data...")
+    return df
     
-def process_log_data(spark, input_data, output_data):
-    """Process data from the log and song JSON files into users, time and 
+def process_log_data(spark, input_data, output_data, song_df):
+    """Process data from the log JSON files and song data into users, time and 
        song_plays tables in the star schema.
     
     Args:
         spark (SparkSession): SparkSessionObject
         input_data (str): location of JSON files.
         output_data (str): location to write parquet files.
+        song_df (DataFrame): song data returned by process_song_data.
     """
 
-     # get filepath to log and song data file
+     # get filepath to log data file
     log_data = input_data + "log-data/*/*/*.json"
-    song_data = input_data + "song-data/*/*/*/*.json"
     
-    # schema for log files
-    schema = StructType([
-        StructField('artist', StringType(), True),
-        StructField('auth', StringType(), True),
-        StructField('firstName', StringType(), True),
-        StructField('gender', StringType(), True),
-        StructField('itemInSession', LongType(), True),
-        StructField('lastName', StringType(), True),
-        StructField('length', DoubleType(), True),
-        StructField('level', StringType(), True),
-        StructField('location', StringType(), True),
-        StructField('method', StringType(), True),
-        StructField('page', StringType(), True),
-        StructField('registration', FloatType(), True),
-        StructField('sessionId', IntegerType(), True),
-        StructField('song', StringType(), True),
-        StructField('status', IntegerType(), True),
-        StructField('ts', FloatType(), True),
-        StructField('userAgent', StringType(), True),
-        StructField('userId', StringType(), True),
-    ])
-    
-    
-    # read log data file
+    # read log data file, filtering by actions for song plays and keeping 
+    # only the columns used by the users, time and songplays tables
     print("Reading files... {}".format(log_data))
-    df = spark.read.json(log_data, schema=schema)
+    df_filtered = spark.read.schema(LOG_SCHEMA) \
+        .option('mode', 'DROPMALFORMED') \
+        .json(log_data) \
+        .where(col('page') == 'NextSong') \
+        .select('artist', 'firstName', 'gender', 'lastName', 'length', 'level', 
+                'location', 'sessionId', 'song', 'ts', 'userAgent', 'userId')
+    
+    # create timestamp column from original timestamp column (epoch milliseconds)
+    df_filtered = df_filtered.withColumn('ts', (col('ts') / 1000).cast(TimestampType()))
     
-    # filter by actions for song plays
-    print("Filtering log data")
-    df_filtered = df.filter(df.page =='NextSong')
+    # filtered logs are used by every table below, so cache them once
+    df_filtered = df_filtered.persist(StorageLevel.MEMORY_AND_DISK)
+    print("Cached {} log rows".format(df_filtered.count()))
 
-    # extract columns for users table 
+    # extract columns for users table, keeping one row per user with their 
+    # most recent level (users can move from free to paid)
     print("Extracting users table columns")
-    users_table = df_filtered.select(col('userId').alias('user_id'),
-                                     col('firstName').alias('first_name'),
-                                     col('lastName').alias('last_name'),
-                                     'gender',
-                                     'level').distinct() 
+    latest = Window.partitionBy('userId').orderBy(col('ts').desc())
+    users_table = df_filtered.withColumn('row_num', row_number().over(latest)) \
+                             .where(col('row_num') == 1) \
+                             .selectExpr('userId as user_id',
+                                         'firstName as first_name',
+                                         'lastName as last_name',
+                                         'gender',
+                                         'level')
     
     # write users table to parquet files
     print("Writing users table")
-    users_table.write.parquet(output_data + "users.parquet", mode="overwrite") 
+    spark.sparkContext.setJobGroup('users', 'Write users table')
+    users_table.repartition(1).write.parquet(output_data + "users.parquet", mode="overwrite")
 
-    # create timestamp column from original timestamp column
-    #https://stackoverflow.com/questions/49971903/converting-epoch-to-datetime-in-pyspark-data-frame-using-udf
-    print("Converting to timestamp")
-    ts_format = "yyyy-MM-dd HH:MM:ss z"
-    df = df_filtered.withColumn('ts', to_timestamp(date_format((df.ts / 1000).cast(dataType=TimestampType()), ts_format), ts_format))   
-
-    # extract columns to create time table
+    # extract columns to create time table, deduplicating on start_time first 
+    # so the date parts are only computed once per unique timestamp
     print("Selecting for time table...")
-    time_table = df.select(col('ts').alias('start_time'),
-                           hour(col('ts')).alias('hour'),
-                           dayofmonth(col('ts')).alias('day'),
-                           weekofyear(col('ts')).alias('week'),
-                           month(col('ts')).alias('month'),
-                           year(col('ts')).alias('year')).distinct() 
+    time_table = df_filtered.select(col('ts').alias('start_time')).dropDuplicates()
     
-    time_table = time_table.withColumn('weekday', date_format('start_time','u'))
+    time_table = time_table.withColumn('hour', hour('start_time')) \
+                           .withColumn('day', dayofmonth('start_time')) \
+                           .withColumn('week', weekofyear('start_time')) \
+                           .withColumn('month', month('start_time')) \
+                           .withColumn('year', year('start_time')) \
+                           .withColumn('weekday', date_format('start_time','u'))
     
     # write time table to parquet files partitioned by year and month
     print("Writing time table...")
-    time_table.write.partitionBy('year','month').parquet(output_data + "time.parquet", mode="overwrite")
-    
-    #schema for song files
-    song_schema = StructType([
-        StructField('artist_id', StringType(), True),
-        StructField('artist_latitude', DoubleType(), True),
-        StructField('artist_longitude', DoubleType(), True),
-        StructField('artist_location', StringType(), True),
-        StructField('artist_name', StringType(), True),
-        StructField('song_id', StringType(), True),
-        StructField('title', StringType(), True),
-        StructField('duration', DoubleType(), True),
-        StructField('year', DoubleType(), True),
-    ])
-
-    # read in song data to use for songplays table
-    print("Reading file... {}".format(song_data))
-    song_df = spark.read.json(song_data, schema=song_schema)
+    spark.sparkContext.setJobGroup('time', 'Write time table')
+    time_table.repartition('year','month').write.partitionBy('year','month').parquet(output_data + "time.parquet", mode="overwrite")
+    
+    # only keep the columns and rows that can match the join, keeps the broadcast small
+    song_df = song_df.select('song_id', 'artist_id', 'artist_name', 'title', 'duration') \
+                     .where('artist_name is not null and title is not null and duration is not null')
+
+    # only keep the log columns needed for the join and songplays table
+    log_df = df_filtered.select('ts', 'userId', 'level', 'sessionId', 'location', 
+                       'userAgent', 'artist', 'song', 'length')
 
     #join tables
     print("Joining songs and log data")
-    song_plays = song_df.join(df, (df.artist == song_df.artist_name) 
-                                  & (df.song == song_df.title)
-                                  & (df.length == song_df.duration))
+    if SALT_SONGPLAYS_JOIN:
+        # salt the logs and replicate the songs over every salt value, so plays 
+        # of popular songs are spread across several partitions
+        log_df = log_df.withColumn('salt', (rand() * SALT_BUCKETS).cast('int'))
+        song_df = song_df.withColumn('salt', explode(array([lit(i) for i in range(SALT_BUCKETS)])))
+        song_plays = log_df.join(song_df, (log_df.artist == song_df.artist_name) 
+                                          & (log_df.song == song_df.title)
+                                          & (log_df.length == song_df.duration)
+                                          & (log_df.salt == song_df.salt))
+    else:
+        # song catalog is small so broadcast it to avoid shuffling the logs
+        song_plays = log_df.join(broadcast(song_df), (log_df.artist == song_df.artist_name) 
+                                                     & (log_df.song == song_df.title)
+                                                     & (log_df.length == song_df.duration))
    
-    #Add an increasing ID
+    #Add a deterministic ID hashed from the natural key, stable across reruns
     print("Adding ID to songplays")
-    song_plays = song_plays.withColumn('songplay_id', monotonically_increasing_id())
+    song_plays = song_plays.withColumn('songplay_id', xxhash64('ts', 'userId', 'sessionId', 'song_id'))
     
     #Select appropriate columns
     print("Selecting columns for songplay")
-    song_plays = song_plays.select(col('songplay_id'),
-                                   col('ts').alias('start_time'),
-                                   col('userId').alias('user_id'),
-                                   col('level'),
-                                   col('song_id'),
-                                   col('artist_id'),
-                                   col('sessionId').alias('session_id'),
-                                   col('location'),
-                                   col('userAgent').alias('user_agent'),
-                                   month(col('ts')).alias('month'),
-                                   year(col('ts')).alias('year'))
+    song_plays = song_plays.selectExpr('songplay_id',
+                                       'ts as start_time',
+                                       'userId as user_id',
+                                       'level',
+                                       'song_id',
+                                       'artist_id',
+                                       'sessionId as session_id',
+                                       'location',
+                                       'userAgent as user_agent',
+                                       'month(ts) as month',
+                                       'year(ts) as year')
     
     print("Writing songplays to file...")
-    song_plays.write.partitionBy('year','month').parquet(output_data + 'song_plays.parquet', mode="overwrite")
+    spark.sparkContext.setJobGroup('song_plays', 'Join and write songplays table')
+    song_plays.repartition('year','month').write.partitionBy('year','month').parquet(output_data + 'song_plays.parquet', mode="overwrite")
+    spark.sparkContext.setJobGroup(None, None)
+    
+    df_filtered.unpersist()
 
     
 def main():
     """Main pipeline begins here, take data from input and transform to output location."""
     
-    spark = create_spark_session()
     input_data =  "s3a://udacity-dend/"
     output_data = "s3a://dend-test-us-west/"
     output_data = "data/"
+    spark = create_spark_session(output_data)
     
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    song_df = process_song_data(spark, input_data, output_data)
+    process_log_data(spark, input_data, output_data, song_df)
+    song_df.unpersist()
 
 if __name__ == "__main__":
     main()